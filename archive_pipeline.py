@@ -0,0 +1,177 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from authentication import get_thread_http
+from constants import BATCH_SIZE, MAX_BATCH_WORKERS, PARSER_WORKERS, PIPELINE_QUEUE_SIZE, \
+    STAGE_SHUTDOWN_POLL_SECONDS, WRITER_WORKERS
+from email_processor import EMAIL_PARSERS, QuotaThrottle, iter_fetched_emails
+from persistence_handler import get_archive_month
+
+logger = logging.getLogger(__name__)
+
+_STAGE_DONE = object()
+
+
+def configure_parser_logging():
+    """
+    Sends log records of a parser process straight to stdout.
+
+    Parser processes exit without running the logging shutdown hooks, so they must not buffer
+    records the way the main process does. They are spawned rather than forked, so they start
+    without the main process's handlers and nothing buffered there is printed twice.
+
+    Returns:
+        None
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+
+
+def shut_down_stage(stage_queue, consumers):
+    """
+    Tells the consumer threads of a pipeline queue to finish, and waits for them.
+
+    The end-of-stage sentinels are queued behind the items still waiting to be consumed. If
+    every consumer has already exited, the queue can be full with nobody left to empty it, so
+    the sentinels are given up on instead of blocking forever.
+
+    Args:
+        stage_queue (queue.Queue): The queue the consumers read from.
+        consumers (list): The consumer threads, each of which exits on one sentinel.
+
+    Returns:
+        None
+    """
+    for _ in consumers:
+        while True:
+            try:
+                stage_queue.put(_STAGE_DONE, timeout=STAGE_SHUTDOWN_POLL_SECONDS)
+                break
+            except queue.Full:
+                if not any(thread.is_alive() for thread in consumers):
+                    return
+    for thread in consumers:
+        thread.join()
+
+
+def run_archive_pipeline(service, creds, message_ids, archive_writer, archived_ids=None, message_format='raw'):
+    """
+    Fetches, parses and archives emails in three concurrent stages.
+
+    Fetcher threads download batches of raw emails, parser threads hand them to a pool of
+    processes that turn them into email data dictionaries outside the GIL, and writer threads
+    stream those into the archive. Emails are routed to writers by month, so each month archive
+    is compressed by a single writer while different months are compressed in parallel (zlib
+    releases the GIL). The stages are connected by bounded queues, so a slow stage applies
+    backpressure to the ones before it instead of letting emails pile up in memory.
+
+    If the parser processes die (for instance by running out of memory) or the run is
+    interrupted, fetching stops, the emails already in flight are dropped and every stage is
+    still shut down, so the archives can be closed with everything written so far.
+
+    Args:
+        service (googleapiclient.discovery.Resource): The shared Gmail API service.
+        creds (google.oauth2.credentials.Credentials): The credentials for accessing the Gmail API.
+        message_ids (iterable): The message IDs of the emails to archive, consumed lazily.
+        archive_writer (persistence_handler.ArchiveWriter): The writer the emails are archived with.
+        archived_ids (list): Optional list that the message ID of every email written to the
+            archive is appended to.
+        message_format (str): The Gmail message format to fetch: 'raw' for complete emails, 'full'
+            to leave out attachments or 'metadata' for headers only.
+
+    Returns:
+        int: The number of message IDs consumed.
+    """
+    message_ids = iter(message_ids)
+    parse_email = EMAIL_PARSERS[message_format]
+    batches_lock = threading.Lock()
+    pipeline_failed = threading.Event()
+    throttle = QuotaThrottle()
+    total_ids = 0
+    raw_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    parsed_queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(WRITER_WORKERS)]
+
+    def fetch():
+        nonlocal total_ids
+        http = get_thread_http(creds)
+        while not pipeline_failed.is_set():
+            with batches_lock:
+                batch = list(itertools.islice(message_ids, BATCH_SIZE))
+                total_ids += len(batch)
+            if not batch:
+                return
+            for fetched in iter_fetched_emails(service, http, batch, message_format, throttle):
+                if pipeline_failed.is_set():
+                    return
+                raw_queue.put(fetched)
+
+    def parse():
+        while True:
+            fetched = raw_queue.get()
+            if fetched is _STAGE_DONE:
+                return
+            if pipeline_failed.is_set():
+                continue  # Drain the queue so fetchers blocked on it can stop
+            try:
+                email_data = parse_pool.submit(parse_email, fetched[1], fetched[0]).result()
+            except BaseException as e:
+                if isinstance(e, Exception) and not isinstance(e, BrokenProcessPool):
+                    logger.error("Failed to parse email ID %s: %s", fetched[0], e)
+                    continue
+                # The pool is broken, or a worker was interrupted (Ctrl-C reaches the parser
+                # processes too and comes back through the future), so stop the whole run
+                logger.error("Parsing stopped, ending the archive run early: %r", e)
+                pipeline_failed.set()
+                continue
+            if not email_data:
+                continue
+            try:
+                year, month = get_archive_month(email_data)
+                writer_index = (int(year) * 12 + int(month)) % WRITER_WORKERS
+            except (TypeError, ValueError):
+                writer_index = 0  # The writer reports emails without a usable date
+            parsed_queues[writer_index].put(email_data)
+
+    def record_archived(written_ids):
+        if archived_ids is not None:
+            archived_ids.extend(written_ids)
+
+    def write(parsed_queue):
+        while True:
+            email_data = parsed_queue.get()
+            if email_data is _STAGE_DONE:
+                return
+            # Each email goes straight into its zip entries, so holding emails back to write them
+            # in batches would only keep more of them in memory
+            record_archived(archive_writer.write_buffer([email_data]))
+
+    # Daemon fetchers cannot keep the process alive if a run is interrupted mid-fetch
+    fetchers = [threading.Thread(target=fetch, daemon=True) for _ in range(MAX_BATCH_WORKERS)]
+    parsers = [threading.Thread(target=parse) for _ in range(PARSER_WORKERS)]
+    writers = [threading.Thread(target=write, args=(parsed_queue,)) for parsed_queue in parsed_queues]
+    # Spawn the parser processes: forking them lazily from the parser threads could copy locks
+    # held by other threads, and would hand them the main process's logging handlers
+    parse_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=PARSER_WORKERS, mp_context=parse_context,
+                             initializer=configure_parser_logging) as parse_pool:
+        for thread in fetchers + parsers + writers:
+            thread.start()
+
+        try:
+            for thread in fetchers:
+                thread.join()
+        except BaseException:
+            pipeline_failed.set()
+            raise
+        finally:
+            # Shut the later stages down however fetching ended, so the writers finish and the
+            # archives can be closed
+            shut_down_stage(raw_queue, parsers)
+            for parsed_queue, writer in zip(parsed_queues, writers):
+                shut_down_stage(parsed_queue, [writer])
+    return total_ids
@@ -1,10 +1,41 @@
 import os
+import threading
 
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from googleapiclient.model import JsonModel
 
-from constants import SCOPES
+from constants import HTTP_TIMEOUT, SCOPES
+
+try:
+    # orjson parses the large JSON bodies of raw messages much faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
+_thread_local = threading.local()
+
+
+class OrjsonModel(JsonModel):
+    """
+    A JSON model that parses API responses with orjson.
+
+    Responses orjson cannot parse are handed to the standard model, which also handles non-JSON
+    error bodies.
+    """
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and isinstance(body, dict) and "data" in body:
+            body = body["data"]
+        return body
 
 
 def authenticate_gmail():
@@ -32,3 +63,38 @@ def authenticate_gmail():
         with open("token.json", "w") as token:
             token.write(creds.to_json())
     return creds
+
+
+def build_gmail_service(creds):
+    """
+    Builds the Gmail API service once so it can be shared by every stage of a run.
+
+    Args:
+        creds (google.oauth2.credentials.Credentials): The authenticated credentials.
+
+    Returns:
+        googleapiclient.discovery.Resource: The Gmail API service.
+    """
+    model = OrjsonModel() if orjson is not None else None
+    return build("gmail", "v1", http=get_thread_http(creds), cache_discovery=False, model=model)
+
+
+def get_thread_http(creds):
+    """
+    Returns the authorized HTTP transport of the calling thread, creating it on first use.
+
+    httplib2 transports are not thread-safe, so requests built from a shared service are
+    executed with a transport owned by the calling thread. Each thread reuses its transport,
+    keeping its connections alive instead of opening a new TLS connection per request.
+
+    Args:
+        creds (google.oauth2.credentials.Credentials): The authenticated credentials.
+
+    Returns:
+        google_auth_httplib2.AuthorizedHttp: The authorized transport.
+    """
+    http = getattr(_thread_local, "http", None)
+    if http is None or http.credentials is not creds:
+        http = AuthorizedHttp(creds, http=httplib2.Http(cache=None, timeout=HTTP_TIMEOUT))
+        _thread_local.http = http
+    return http
@@ -1,10 +1,16 @@
+import os
+
 SCOPES = ["https://mail.google.com/"]
-MAX_WORKERS = 10
 MAX_RETRIES = 5
-total_emails = 0
-emails_downloaded = 0
-emails_deleted = 0
-attachments_saved = 0
-space_saved = 0
-zip_files_created = 0
-original_size = 0
+HTTP_TIMEOUT = 30
+GMAIL_QUOTA_UNITS_PER_SECOND = 250  # Gmail's per-user quota
+MESSAGE_GET_QUOTA_UNITS = 5
+BATCH_SIZE = 100
+MAX_BATCH_WORKERS = 2
+PARSER_WORKERS = os.cpu_count() or 1
+WRITER_WORKERS = 4
+PIPELINE_QUEUE_SIZE = 256
+STAGE_SHUTDOWN_POLL_SECONDS = 0.5
+ARCHIVE_BUFFER_SIZE = 1 << 20
+ARCHIVE_COMPRESSLEVEL = 3
+LOG_BUFFER_CAPACITY = 256
@@ -1,30 +1,34 @@
-from googleapiclient.discovery import build
+import logging
+
 from googleapiclient.errors import HttpError
 
+from constants import MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
 
-def delete_emails(creds, message_ids):
+def delete_emails(service, message_ids):
     """
     Deletes emails based on their message IDs.
 
     Args:
-        creds: Authenticated Gmail API credentials.
+        service (googleapiclient.discovery.Resource): The Gmail API service.
         message_ids (list): List of email message IDs to delete.
 
     Returns:
         int: Number of emails successfully deleted.
     """
-    service = build("gmail", "v1", credentials=creds)
     deleted_count = 0
 
     try:
         for i in range(0, len(message_ids), 1000):  # Gmail allows batch deletion of up to 1000 emails at a time
             batch = message_ids[i:i + 1000]
-            service.users().messages().batchDelete(userId="me", body={"ids": batch}).execute()
+            service.users().messages().batchDelete(userId="me", body={"ids": batch}).execute(num_retries=MAX_RETRIES)
             deleted_count += len(batch)
-            print(f"Deleted {len(batch)} emails.")
+            logger.info("Deleted %d emails.", len(batch))
     except HttpError as error:
-        print(f"Error during email deletion: {error}")
+        logger.error("Error during email deletion: %s", error)
     except Exception as e:
-        print(f"Unexpected error during email deletion: {e}")
+        logger.error("Unexpected error during email deletion: %s", e)
 
     return deleted_count
@@ -1,21 +1,68 @@
-import base64
+import binascii
 import datetime
 import email
+import functools
 import hashlib
+import logging
+import random
+import threading
 import time
 from email import policy
+from email.errors import HeaderParseError
+from email.header import Header, decode_header, make_header
+from email.message import Message
 from email.parser import BytesParser
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-from constants import MAX_RETRIES
+from constants import GMAIL_QUOTA_UNITS_PER_SECOND, MAX_RETRIES, MESSAGE_GET_QUOTA_UNITS
 
+logger = logging.getLogger(__name__)
 
+
+class FilenameTranslationTable(dict):
+    """
+    A `str.translate` table that deletes every character not allowed in a filename.
+
+    Code points are classified on first lookup and cached, so after warm-up `str.translate`
+    resolves each character with a plain dict lookup.
+    """
+
+    def __missing__(self, code_point):
+        char = chr(code_point)
+        value = code_point if char.isalnum() or char in (' ', '.', '_', '-') else None
+        self[code_point] = value
+        return value
+
+
+FILENAME_TRANSLATION_TABLE = FilenameTranslationTable()
+# The ASCII characters FILENAME_TRANSLATION_TABLE deletes, for the bytes.translate fast path
+ASCII_FILENAME_DELETE_BYTES = bytes(
+    code_point for code_point in range(128) if FILENAME_TRANSLATION_TABLE[code_point] is None
+)
+TEXT_CONTENT_TYPES = frozenset({'text/plain', 'text/html'})
+UTF8_COMPATIBLE_CHARSETS = frozenset({'utf-8', 'utf8', 'us-ascii', 'ascii'})
+# Partial response masks: only the parts of a message resource each parser reads are requested
+MESSAGE_FIELDS = {
+    'raw': 'raw',
+    'full': 'payload',
+    'metadata': 'payload/headers',
+}
+RAW_EMAIL_PARSER = BytesParser(policy=policy.compat32)  # Stateless, so one instance serves every message
+URLSAFE_BASE64_TRANSLATION = str.maketrans('-_', '+/')
+# Deletes the line breaks of folded header lines, keeping the whitespace that follows them
+HEADER_UNFOLD_TRANSLATION = str.maketrans('', '', '\r\n')
+
+
+@functools.lru_cache(maxsize=4096)
 def sanitize_filename(filename, max_length=100):
     """
     Sanitizes a string to be used as a safe filename.
 
+    Results are cached, since the same senders come up again and again. ASCII names, the vast
+    majority, are filtered with bytes.translate, which is several times faster than
+    str.translate with a mapping.
+
     Args:
         filename (str): The original filename.
         max_length (int): The maximum length of the sanitized filename.
@@ -23,71 +70,210 @@ def sanitize_filename(filename, max_length=100):
     Returns:
         str: The sanitized filename.
     """
-    sanitized = ''.join(c for c in filename if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
-    return sanitized[:max_length]
+    if filename.isascii():
+        sanitized = filename.encode('ascii').translate(None, ASCII_FILENAME_DELETE_BYTES).decode('ascii')
+    else:
+        sanitized = filename.translate(FILENAME_TRANSLATION_TABLE)
+    return sanitized.rstrip()[:max_length]
+
+
+def decode_urlsafe_base64(data):
+    """
+    Decodes URL-safe base64 text, as Gmail returns message and body data.
+
+    The text is decoded by binascii directly, without the ASCII encoded copy that
+    base64.urlsafe_b64decode makes first.
+
+    Args:
+        data (str): The URL-safe base64 text.
+
+    Returns:
+        bytes: The decoded data.
+    """
+    return binascii.a2b_base64(data.translate(URLSAFE_BASE64_TRANSLATION))
+
+
+def decode_header_value(value):
+    """
+    Unfolds a raw header value and decodes its RFC 2047 encoded words.
+
+    The compat32 policy hands header values back as they appear in the message, so this gives
+    the same text policy.default would: on a single line, with encoded words decoded and raw
+    8-bit bytes read as UTF-8.
+
+    Args:
+        value (str or email.header.Header): The raw header value; compat32 returns values with
+            raw 8-bit bytes as Header objects.
+
+    Returns:
+        str: The decoded header value, or the unfolded value if it cannot be decoded.
+    """
+    if isinstance(value, Header):
+        value = ''.join(chunk.decode('utf-8', errors='replace') if isinstance(chunk, bytes) else chunk
+                        for chunk, _ in decode_header(value))
+    value = value.translate(HEADER_UNFOLD_TRANSLATION)
+    if '=?' not in value:
+        return value  # Nothing encoded, which is most headers
+    try:
+        return str(make_header(decode_header(value)))
+    except (HeaderParseError, LookupError, UnicodeError):
+        return value
+
+
+def iter_leaf_parts(email_message):
+    """
+    Yields the non-multipart parts of a multipart email, depth first.
+
+    Args:
+        email_message (email.message.Message): The multipart email message object.
+
+    Yields:
+        email.message.Message: Each leaf part of the message.
+    """
+    for part in email_message.get_payload():
+        if part.is_multipart():
+            yield from iter_leaf_parts(part)
+        else:
+            yield part
 
 
-def prepare_email_data(email_message, msg_id):
+def encode_text_utf8(payload, charset):
+    """
+    Converts text bytes from their declared charset to UTF-8.
+
+    Text that is already UTF-8 (or ASCII), which is most modern mail, and text in an unknown
+    charset is returned as is instead of being decoded and encoded again.
+
+    Args:
+        payload (bytes): The encoded text.
+        charset (str): The declared charset.
+
+    Returns:
+        bytes: The UTF-8 encoded text.
+    """
+    if not charset or charset.lower() in UTF8_COMPATIBLE_CHARSETS:
+        return payload
+    try:
+        return payload.decode(charset, errors='replace').encode('utf-8')
+    except LookupError:
+        return payload
+
+
+def encode_text_part(part):
+    """
+    Converts the payload of a text part to UTF-8 using its declared charset.
+
+    Args:
+        part (email.message.Message): The text part.
+
+    Returns:
+        bytes: The UTF-8 encoded text.
+    """
+    return encode_text_utf8(part.get_payload(decode=True) or b'', part.get_content_charset('utf-8'))
+
+
+def message_from_headers(headers):
+    """
+    Builds a header-only message from the header list of a Gmail message resource.
+
+    Args:
+        headers (list): The 'headers' list of a message payload or part, as name/value dicts.
+
+    Returns:
+        email.message.Message: A message carrying those headers.
+    """
+    email_message = Message()
+    for header in headers:
+        email_message[header['name']] = header['value']
+    return email_message
+
+
+def encode_payload_text(part):
+    """
+    Converts the body of a text part of a Gmail message resource fetched with format 'full' to
+    UTF-8.
+
+    Args:
+        part (dict): The payload part.
+
+    Returns:
+        bytes: The UTF-8 encoded text.
+    """
+    payload = decode_urlsafe_base64(part['body']['data'])
+    return encode_text_utf8(payload, message_from_headers(part.get('headers', [])).get_content_charset('utf-8'))
+
+
+def prepare_email_data(email_message, msg_id, headers_only=False):
     """
     Extracts and structures email data for buffering.
 
+    Parts are classified by their headers before any payload is decoded. When an email has both
+    an html and a plain text body, only the html body is kept. Bodies are kept as UTF-8 bytes,
+    ready to be written to the archive.
+
     Args:
-        email_message (email.message.EmailMessage): The email message object.
+        email_message (email.message.Message): The email message object.
         msg_id (str): The message ID of the email.
+        headers_only (bool): Whether to skip the body and attachments.
 
     Returns:
         dict: A dictionary containing structured email data.
     """
-    sender = email_message.get('From', 'unknown_sender')
-    subject = email_message.get('Subject', 'no_subject')
-    date_str = email_message.get('Date', '')
-    content_parts = []
+    sender = decode_header_value(email_message.get('From', 'unknown_sender'))
+    subject = decode_header_value(email_message.get('Subject', 'no_subject'))
+    date_str = decode_header_value(email_message.get('Date', ''))
+    text_parts = {}
     attachments = []
 
     safe_sender = sanitize_filename(sender, max_length=50)
-    safe_subject = sanitize_filename(subject, max_length=50)
 
     try:
         parsed_date = email.utils.parsedate_to_datetime(date_str)
+        archive_month = (parsed_date.strftime('%Y'), parsed_date.strftime('%m'))
     except (TypeError, ValueError, IndexError):
         parsed_date = datetime.datetime.now()
+        archive_month = None  # No month archive to put the email in
     email_date_formatted = parsed_date.strftime('%Y%m%d_%H%M%S')
 
     email_folder_name = f"{email_date_formatted}_{safe_sender}_{msg_id}"
     if len(email_folder_name) > 100:
-        hash_str = hashlib.md5(email_folder_name.encode()).hexdigest()
+        hash_str = hashlib.blake2b(email_folder_name.encode(), digest_size=8).hexdigest()
         email_folder_name = f"{email_date_formatted}_{hash_str}"
 
-    if email_message.is_multipart():
-        for part in email_message.walk():
-            content_type = part.get_content_type()
-            disposition = str(part.get('Content-Disposition') or '')
-            if 'attachment' not in disposition.lower():
-                if content_type in ['text/plain', 'text/html']:
-                    charset = part.get_content_charset('utf-8') or 'utf-8'
-                    content = part.get_payload(decode=True).decode(charset, errors='replace')
-                    content_parts.append((content_type, content))
-            else:
-                attachment = extract_attachment(part)
-                if attachment:
-                    attachments.append(attachment)
+    if headers_only:
+        parts = ()
+    elif email_message.is_multipart():
+        parts = iter_leaf_parts(email_message)
     else:
-        content_type = email_message.get_content_type()
-        if content_type in ['text/plain', 'text/html']:
-            charset = email_message.get_content_charset('utf-8') or 'utf-8'
-            content = email_message.get_payload(decode=True).decode(charset, errors='replace')
-            content_parts.append((content_type, content))
+        parts = (email_message,)
+    for part in parts:
+        if part.get_content_disposition() == 'attachment':
+            attachment = extract_attachment(part)
+            if attachment:
+                attachments.append(attachment)
+        elif part.get_content_maintype() == 'text':
+            content_type = part.get_content_type()
+            if content_type in TEXT_CONTENT_TYPES:
+                text_parts.setdefault(content_type, []).append(part)
 
-    headers = {header: value for header, value in email_message.items()}
+    # Prefer the html body; the plain text alternative is dropped without being decoded
+    content_type = 'text/html' if 'text/html' in text_parts else 'text/plain'
+    content_parts = []
+    if content_type in text_parts:
+        content = b'\n'.join(encode_text_part(part) for part in text_parts[content_type])
+        content_parts.append((content_type, content))
 
     email_data = {
+        'msg_id': msg_id,
         'folder_name': email_folder_name,
         'sender': sender,
         'subject': subject,
         'date_str': date_str,
+        'archive_month': archive_month,
         'content_parts': content_parts,
         'attachments': attachments,
-        'headers': headers
+        'headers': [(header, decode_header_value(value)) for header, value in email_message.items()],
+        'complete': not headers_only,  # Whether the bodies and attachments are included
     }
     return email_data
 
@@ -96,15 +282,19 @@ def extract_attachment(part):
     """
     Extracts attachment data from an email part.
 
+    The attachment is decoded here, in the parser process, so the smaller decoded bytes are what
+    is sent back to the main process and buffered for the archive.
+
     Args:
-        part (email.message.EmailMessage): The email part containing the attachment.
+        part (email.message.Message): The email part containing the attachment.
 
     Returns:
-        dict: A dictionary containing the filename and data of the attachment, or None if no attachment is found.
+        dict: A dictionary containing the filename and data of the attachment, or None if no
+        attachment is found.
     """
     filename = part.get_filename()
     if filename:
-        filename = email.utils.collapse_rfc2231_value(filename)
+        filename = decode_header_value(email.utils.collapse_rfc2231_value(filename))
         filename = sanitize_filename(filename)
         file_data = part.get_payload(decode=True)
         if file_data:
@@ -112,35 +302,232 @@ def extract_attachment(part):
     return None
 
 
-def process_email(creds, msg_id):
+def parse_raw_email(message, msg_id):
     """
-    Processes a single email message.
+    Decodes and parses a raw Gmail message resource.
 
     Args:
-        creds (google.oauth2.credentials.Credentials): The credentials for accessing the Gmail API.
+        message (dict): The message resource returned by the Gmail API with format 'raw'.
         msg_id (str): The message ID of the email.
 
     Returns:
-        dict: A dictionary containing structured email data, or None if processing fails.
+        dict: A dictionary containing structured email data, or None if parsing fails.
+    """
+    try:
+        email_raw = decode_urlsafe_base64(message['raw'])
+        email_message = RAW_EMAIL_PARSER.parsebytes(email_raw)
+        return prepare_email_data(email_message, msg_id)
+    except Exception as e:
+        logger.error("Failed to process email ID %s: %s", msg_id, e)
+        return None
+
+
+def parse_metadata_email(message, msg_id):
     """
-    global emails_downloaded
-    global emails_deleted
+    Structures a Gmail message resource fetched with format 'metadata'.
+
+    Gmail only returns the headers in this format, so no MIME parsing is needed.
+
+    Args:
+        message (dict): The message resource returned by the Gmail API with format 'metadata'.
+        msg_id (str): The message ID of the email.
+
+    Returns:
+        dict: A dictionary containing structured email data without body or attachments, or None
+        if processing fails.
+    """
+    try:
+        email_message = message_from_headers(message['payload'].get('headers', []))
+        return prepare_email_data(email_message, msg_id, headers_only=True)
+    except Exception as e:
+        logger.error("Failed to process email ID %s: %s", msg_id, e)
+        return None
+
+
+def iter_payload_parts(payload):
+    """
+    Yields the leaf parts of a Gmail message payload, depth first.
+
+    Args:
+        payload (dict): The payload (or a part) of a message resource fetched with format 'full'.
+
+    Yields:
+        dict: Each part that has no nested parts.
+    """
+    parts = payload.get('parts')
+    if parts:
+        for part in parts:
+            yield from iter_payload_parts(part)
+    else:
+        yield payload
+
+
+def parse_full_email(message, msg_id):
+    """
+    Structures a Gmail message resource fetched with format 'full', leaving out attachments.
+
+    Gmail returns the message already split into parts, with attachments only referenced by ID,
+    so the bodies are taken from the JSON payload without downloading or parsing the raw email.
+
+    Args:
+        message (dict): The message resource returned by the Gmail API with format 'full'.
+        msg_id (str): The message ID of the email.
+
+    Returns:
+        dict: A dictionary containing structured email data without attachments, or None if
+        processing fails.
+    """
+    try:
+        payload = message['payload']
+        email_data = prepare_email_data(message_from_headers(payload.get('headers', [])), msg_id, headers_only=True)
+
+        text_parts = {}
+        for part in iter_payload_parts(payload):
+            body = part.get('body', {})
+            if part.get('filename') or 'attachmentId' in body or not body.get('data'):
+                continue
+            if part.get('mimeType') in TEXT_CONTENT_TYPES:
+                text_parts.setdefault(part['mimeType'], []).append(part)
+
+        # Prefer the html body, as for raw emails
+        content_type = 'text/html' if 'text/html' in text_parts else 'text/plain'
+        if content_type in text_parts:
+            content = b'\n'.join(encode_payload_text(part) for part in text_parts[content_type])
+            email_data['content_parts'] = [(content_type, content)]
+        return email_data
+    except Exception as e:
+        logger.error("Failed to process email ID %s: %s", msg_id, e)
+        return None
+
 
-    service = build("gmail", "v1", credentials=creds)
+def is_retryable_error(error):
+    """
+    Checks whether a Gmail API error is transient and worth retrying.
+
+    Args:
+        error (Exception): The error raised by the Gmail API client.
+
+    Returns:
+        bool: True for rate limiting (HTTP 429) and server errors (HTTP 5xx).
+    """
+    return isinstance(error, HttpError) and (error.resp.status == 429 or error.resp.status >= 500)
+
+
+class QuotaThrottle:
+    """
+    Paces API calls shared by several threads so they stay within Gmail's per-user quota.
+
+    Every call reserves the next free slot on a shared schedule, sized by the quota units it
+    spends, and sleeps until its slot comes up. Threads therefore take turns instead of bursting
+    together into 429 responses and retrying in a cascade.
+    """
+
+    def __init__(self, units_per_second=GMAIL_QUOTA_UNITS_PER_SECOND):
+        """
+        Args:
+            units_per_second (float): The quota units that may be spent per second.
+        """
+        self.units_per_second = units_per_second
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        """
+        Blocks until the given number of quota units may be spent.
+
+        Args:
+            units (int): The quota units the upcoming call spends.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + units / self.units_per_second
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def fetch_raw_emails(service, http, msg_ids, message_format='raw'):
+    """
+    Fetches a group of emails with a single batch HTTP request.
+
+    Args:
+        service (googleapiclient.discovery.Resource): The Gmail API service.
+        http (google_auth_httplib2.AuthorizedHttp): The authorized transport of the calling thread.
+        msg_ids (list): The message IDs to fetch, at most BATCH_SIZE of them.
+        message_format (str): The Gmail message format to request, one of the MESSAGE_FIELDS keys
+            ('raw', 'full' or 'metadata').
+
+    Returns:
+        tuple: A list of (msg_id, message) pairs that were fetched, and a list of message IDs
+        that failed with a retryable error and should be retried.
+    """
+    fetched = []
+    throttled = []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            fetched.append((request_id, response))
+        elif is_retryable_error(exception):
+            throttled.append(request_id)
+        else:
+            logger.error("Error processing email ID %s: %s", request_id, exception)
+
+    batch = service.new_batch_http_request(callback=callback)
+    for msg_id in msg_ids:
+        request = service.users().messages().get(
+            userId="me", id=msg_id, format=message_format, fields=MESSAGE_FIELDS[message_format]
+        )
+        batch.add(request, request_id=msg_id)
+    batch.execute(http=http)
+    return fetched, throttled
+
+
+def iter_fetched_emails(service, http, msg_ids, message_format='raw', throttle=None):
+    """
+    Fetches a group of emails, retrying the ones that failed with a retryable error.
+
+    Failed IDs are sent again in a smaller follow-up batch after an exponential backoff with
+    full jitter, so worker threads that were throttled together do not retry in lockstep.
+
+    Args:
+        service (googleapiclient.discovery.Resource): The shared Gmail API service.
+        http (google_auth_httplib2.AuthorizedHttp): The authorized transport of the calling thread.
+        msg_ids (list): The message IDs to fetch, at most BATCH_SIZE of them.
+        message_format (str): The Gmail message format to request, one of the MESSAGE_FIELDS keys
+            ('raw', 'full' or 'metadata').
+        throttle (QuotaThrottle): The throttle shared by all fetching threads, if any.
+
+    Yields:
+        tuple: A (msg_id, message) pair for each email that was fetched.
+    """
+    pending = list(msg_ids)
     retry_count = 0
-    while retry_count < MAX_RETRIES:
+    while pending:
+        if throttle is not None:
+            throttle.acquire(len(pending) * MESSAGE_GET_QUOTA_UNITS)
         try:
-            message = service.users().messages().get(userId="me", id=msg_id, format='raw').execute()
-            email_raw = base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
-            email_message = BytesParser(policy=policy.default).parsebytes(email_raw)
-            return prepare_email_data(email_message, msg_id)
+            fetched, pending = fetch_raw_emails(service, http, pending, message_format)
         except HttpError as error:
-            if error.resp.status == 429:
-                retry_count += 1
-                time.sleep(2 ** retry_count)
-            else:
-                print(f"Error processing email ID {msg_id}: {error}")
-                return None
+            if not is_retryable_error(error):
+                logger.error("Error fetching batch of %d emails: %s", len(pending), error)
+                return
+            fetched = []
         except Exception as e:
-            print(f"Failed to process email ID {msg_id}: {e}")
-            return None
+            logger.error("Failed to fetch batch of %d emails: %s", len(pending), e)
+            return
+
+        yield from fetched
+
+        if pending:
+            retry_count += 1
+            if retry_count > MAX_RETRIES:
+                logger.error("Giving up on %d emails after %d retries.", len(pending), MAX_RETRIES)
+                return
+            time.sleep(random.uniform(0, 2 ** retry_count))
+
+
+EMAIL_PARSERS = {
+    'raw': parse_raw_email,
+    'full': parse_full_email,
+    'metadata': parse_metadata_email,
+}
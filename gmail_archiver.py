@@ -1,17 +1,62 @@
 import os
+import sys
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+from logging.handlers import MemoryHandler
 
-from authentication import authenticate_gmail
-from constants import MAX_WORKERS, total_emails, emails_downloaded, attachments_saved, space_saved, zip_files_created, \
-    original_size
+from archive_pipeline import run_archive_pipeline
+from authentication import authenticate_gmail, build_gmail_service
+from constants import ARCHIVE_COMPRESSLEVEL, LOG_BUFFER_CAPACITY
 from email_deleter import delete_emails
-from email_processor import process_email
-from persistence_handler import write_buffer_to_disk, compress_month_folder
-from query_processor import build_query, get_message_ids
+from persistence_handler import ArchiveWriter
+from query_processor import build_query, iter_message_ids
 from status_summarizer import summarize_statistics
 
 
+def configure_logging():
+    """
+    Routes log records through a memory buffer so they reach stdout in batches.
+
+    Records are written out whenever the buffer fills up and at the end of each phase of a run,
+    instead of with one write per record.
+
+    Returns:
+        None
+    """
+    handler = MemoryHandler(
+        LOG_BUFFER_CAPACITY, flushLevel=logging.CRITICAL, target=logging.StreamHandler(sys.stdout)
+    )
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[handler])
+
+
+def flush_logs():
+    """
+    Writes out any buffered log records.
+
+    Returns:
+        None
+    """
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+
+def get_message_format(args):
+    """
+    Picks the Gmail message format to fetch, downloading no more than the run archives.
+
+    Args:
+        args (argparse.Namespace): The command-line arguments.
+
+    Returns:
+        str: 'metadata' for headers only, 'full' to leave out attachments, or 'raw' otherwise.
+    """
+    if getattr(args, "headers_only", False):
+        return 'metadata'
+    if getattr(args, "skip_attachments", False):
+        return 'full'
+    return 'raw'
+
+
 def archive_emails(args):
     """
     Archives emails based on arguments.
@@ -23,32 +68,31 @@ def archive_emails(args):
         None
     """
     creds = authenticate_gmail()
+    service = build_gmail_service(creds)
     query = build_query(args)
-    message_ids = get_message_ids(creds, query)
+    message_ids = iter_message_ids(service, query)
+    # Only a deletion run needs the IDs kept around; just the ones that made it into the archive
+    ids_to_delete = [] if getattr(args, "delete", False) else None
 
     folder_path = os.path.expanduser(args.base_path)
     os.makedirs(folder_path, exist_ok=True)
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(process_email, creds, msg_id) for msg_id in message_ids]
-        email_buffer = []
-
-        for future in as_completed(futures):
-            email_data = future.result()
-            if email_data:
-                email_buffer.append(email_data)
-            if len(email_buffer) >= 50:
-                write_buffer_to_disk(email_buffer, folder_path)
-                email_buffer.clear()
-
-        if email_buffer:
-            write_buffer_to_disk(email_buffer, folder_path)
-
-    space_saved, zip_files_created, original_size = compress_month_folder(folder_path)
+    archive_writer = ArchiveWriter(folder_path, getattr(args, "compression_level", ARCHIVE_COMPRESSLEVEL))
+    try:
+        total_emails = run_archive_pipeline(
+            service, creds, message_ids, archive_writer, ids_to_delete, get_message_format(args)
+        )
+    finally:
+        space_saved, zip_files_created, original_size = archive_writer.close()
+        flush_logs()
 
     # Add email deletion logic if the `--delete` flag is passed
     if getattr(args, "delete", False):
-        emails_deleted = delete_emails(creds, message_ids)
+        emails_deleted = delete_emails(service, ids_to_delete)
+        flush_logs()
+
+    if getattr(args, "quiet", False):
+        return
 
     # Update call to include the additional arguments
     summarize_statistics(
@@ -59,10 +103,10 @@ def archive_emails(args):
         label=args.label,
         delete=args.delete,
         total_emails=total_emails,
-        emails_downloaded=emails_downloaded,
+        emails_downloaded=archive_writer.emails_written,
         emails_deleted=emails_deleted if args.delete else -1,
-        attachments_saved=attachments_saved,
-        original_size=space_saved + original_size,  # Update based on tracked sizes
+        attachments_saved=archive_writer.attachments_saved,
+        original_size=original_size,
         space_saved=space_saved,
         zip_files_created=zip_files_created
     )
@@ -70,12 +114,24 @@ def archive_emails(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Gmail Archiver")
-    parser.add_argument("--start-date", type=str, required=True, help="Start date in mm-dd-yyyy format.")
-    parser.add_argument("--end-date", type=str, required=True, help="End date in mm-dd-yyyy format.")
+    parser.add_argument("--start-date", type=str, required=True, help="Start date in mm-dd-yyyy or yyyy-mm-dd format.")
+    parser.add_argument("--end-date", type=str, required=True, help="End date in mm-dd-yyyy or yyyy-mm-dd format.")
     parser.add_argument("--base-path", type=str, default=os.getcwd(), help="Base path for saving emails.")
     parser.add_argument("--query", type=str, default="", help="Custom Gmail search query (e.g., 'is:starred').")
     parser.add_argument("--label", type=str, help="Gmail label to filter emails (e.g., 'INBOX').")
     parser.add_argument("--delete", action="store_true", help="Delete emails after archiving.")
+    parser.add_argument("--headers-only", action="store_true",
+                        help="Archive only the headers of each email, skipping bodies and attachments.")
+    parser.add_argument("--skip-attachments", action="store_true",
+                        help="Archive headers and bodies but do not download attachments.")
+    parser.add_argument("--compression-level", type=int, choices=range(10), default=ARCHIVE_COMPRESSLEVEL,
+                        metavar="0-9", help="Deflate level for the archives; higher is smaller but slower.")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Skip the summary at the end of the run, e.g. for scheduled runs.")
 
     args = parser.parse_args()
+    if args.delete and (args.headers_only or args.skip_attachments):
+        parser.error("--delete cannot be combined with --headers-only or --skip-attachments, "
+                     "as those runs do not archive complete emails.")
+    configure_logging()
     archive_emails(args)
\ No newline at end of file
@@ -1,94 +1,278 @@
-import email
+import logging
 import os
-import shutil
+import threading
+import time
+import zipfile
 
-space_saved, zip_files_created, original_size, attachments_saved = 0, 0, 0, 0
-def write_buffer_to_disk(email_buffer, folder_path):
+from constants import ARCHIVE_BUFFER_SIZE, ARCHIVE_COMPRESSLEVEL
+
+logger = logging.getLogger(__name__)
+
+MAX_COMPRESSLEVEL = 9
+
+try:
+    # zlib-ng is a faster drop-in replacement for zlib; zipfile compresses with it when installed
+    from zlib_ng import zlib_ng
+    zipfile.zlib = zlib_ng
+except ImportError:
+    try:
+        # ISA-L's zlib replacement is the next best, though it only has levels 0-3
+        from isal import isal_zlib
+        zipfile.zlib = isal_zlib
+        MAX_COMPRESSLEVEL = 3
+    except ImportError:
+        pass
+
+# Attachments in these formats are already compressed, so deflating them again costs CPU for
+# next to no space
+STORED_ATTACHMENT_EXTENSIONS = frozenset({
+    '.zip', '.gz', '.jpg', '.jpeg', '.png', '.mp4', '.mov', '.pdf', '.docx', '.xlsx',
+})
+
+# Zip comment on the headers.txt entry of an email archived with its bodies and attachments,
+# as opposed to one from a --headers-only or --skip-attachments run
+COMPLETE_EMAIL_COMMENT = b'complete'
+
+
+def get_archive_month(email_data):
     """
-    Writes buffered emails to disk organized by year/month.
+    Determines which year/month archive an email belongs to.
+
+    The month is worked out from the Date header while the email is parsed, so the header is
+    not parsed again here.
 
     Args:
-        email_buffer (list): A list of email data dictionaries.
-        folder_path (str): The base folder path where emails will be saved.
+        email_data (dict): The email data dictionary.
 
     Returns:
-        None
+        tuple: The four digit year and the two digit month, as strings.
+
+    Raises:
+        ValueError: If the email has no usable date.
     """
-    global attachments_saved
-    for email_data in email_buffer:
-        try:
-            # Extract year and month from email's date
-            date_str = email_data.get('date_str', '')
-            parsed_date = email.utils.parsedate_to_datetime(date_str)
-            year = parsed_date.strftime('%Y')
-            month = parsed_date.strftime('%m')
-
-            # Construct the year/month folder path
-            year_month_path = os.path.join(folder_path, year, month)
-            os.makedirs(year_month_path, exist_ok=True)  # Create year/month folder if it doesn't exist
-
-            # Create the email-specific folder
-            email_folder_path = os.path.join(year_month_path, email_data['folder_name'])
-            os.makedirs(email_folder_path, exist_ok=True)
-
-            # Save email content
-            for content_type, content in email_data['content_parts']:
-                if content_type == 'text/plain':
-                    filename = 'email.txt'
-                elif content_type == 'text/html':
-                    filename = 'email.html'
-                else:
-                    continue
-                filepath = os.path.join(email_folder_path, filename)
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    f.write(content)
-
-            # Save headers
-            headers_filepath = os.path.join(email_folder_path, 'headers.txt')
-            with open(headers_filepath, 'w', encoding='utf-8') as f:
-                f.write(f"From: {email_data['sender']}\n")
-                f.write(f"Date: {email_data['date_str']}\n")
-                f.write(f"Subject: {email_data['subject']}\n")
-                for header, value in email_data['headers'].items():
-                    f.write(f"{header}: {value}\n")
-
-            # Save attachments
-            for attachment in email_data['attachments']:
-                attachments_saved += 1
-                file_path = os.path.join(email_folder_path, attachment['filename'])
-                with open(file_path, 'wb') as f:
-                    f.write(attachment['data'])
-
-        except Exception as e:
-            print(f"Error writing email data to disk for {email_data['folder_name']}: {e}")
-
-
-def compress_month_folder(folder_path):
+    archive_month = email_data.get('archive_month')
+    if archive_month is None:
+        raise ValueError(f"unusable date {email_data.get('date_str', '')!r}")
+    return archive_month
+
+
+def is_readable_zip(path):
     """
-    Compresses each month-level folder.
+    Checks whether a file is a zip archive with an intact central directory.
+
+    zipfile.is_zipfile only looks for the end record, which survives when an interrupted append
+    has overwritten the central directory; opening such a file in append mode would silently
+    start a new, empty archive after the old data.
 
     Args:
-        folder_path (str): The base folder path where emails are saved.
+        path (str): The path of the file.
 
     Returns:
-        None
+        bool: True if the archive's entries can be read.
+    """
+    try:
+        with zipfile.ZipFile(path):
+            return True
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+
+class ArchiveWriter:
     """
-    global space_saved, zip_files_created, original_size  # Declare as global to modify these variables
-
-    for root, dirs, _ in os.walk(folder_path):
-        for dir_name in dirs:
-            month_folder = os.path.join(root, dir_name)
-            if not os.path.isdir(month_folder):
-                continue
-            folder_size_before = sum(
-                os.path.getsize(os.path.join(dirpath, filename))
-                for dirpath, _, filenames in os.walk(month_folder)
-                for filename in filenames
-            )
-            shutil.make_archive(month_folder, 'zip', month_folder)
-            zip_files_created += 1  # Increment the global counter
-            shutil.rmtree(month_folder)
-            zip_size = os.path.getsize(f"{month_folder}.zip")
-            original_size += folder_size_before  # Increment the global counter
-            space_saved += folder_size_before - zip_size  # Increment the global space saved
-            return space_saved, zip_files_created, original_size
\ No newline at end of file
+    Streams emails straight into per-month zip archives, saved as year/month.zip.
+
+    Each month archive is opened once and kept open until `close` is called, so every email is
+    written as in-memory zip entries without an intermediate directory tree on disk. Archives
+    left by earlier runs are appended to, and emails they already contain in full are skipped.
+    Several threads may write concurrently as long as each month is only written by one of them.
+    """
+
+    def __init__(self, folder_path, compresslevel=ARCHIVE_COMPRESSLEVEL):
+        """
+        Args:
+            folder_path (str): The base folder path where the archives will be saved.
+            compresslevel (int): The deflate level (0-9), capped at what the compression library
+                in use supports.
+        """
+        self.folder_path = folder_path
+        self.compresslevel = min(compresslevel, MAX_COMPRESSLEVEL)
+        self.archives = {}
+        self.existing_sizes = {}
+        self.emails_written = 0
+        self.attachments_saved = 0
+        self.counter_lock = threading.Lock()
+
+    def _get_archive(self, year, month):
+        """
+        Returns the open zip archive for a year/month, creating it on first use.
+
+        An existing file that is not a readable zip, such as an archive left without a central
+        directory by an interrupted run, is never overwritten. It is renamed with a '.corrupt'
+        suffix so its emails can still be recovered, and a new archive is started.
+
+        Args:
+            year (str): The four digit year.
+            month (str): The two digit month.
+
+        Returns:
+            zipfile.ZipFile: The archive for that month.
+        """
+        archive = self.archives.get((year, month))
+        if archive is None:
+            year_path = os.path.join(self.folder_path, year)
+            os.makedirs(year_path, exist_ok=True)
+            archive_path = os.path.join(year_path, f"{month}.zip")
+            if is_readable_zip(archive_path):
+                stream = open(archive_path, 'r+b', buffering=ARCHIVE_BUFFER_SIZE)
+                archive = zipfile.ZipFile(stream, 'a', compression=zipfile.ZIP_DEFLATED,
+                                          compresslevel=self.compresslevel)
+                self.existing_sizes[(year, month)] = (
+                    sum(info.file_size for info in archive.infolist()), os.path.getsize(archive_path)
+                )
+            else:
+                if os.path.exists(archive_path):
+                    corrupt_path = self._move_aside(archive_path)
+                    logger.error("%s is not a readable zip archive, most likely left by an interrupted run. "
+                                 "It was moved to %s; its emails can be recovered with 'zip -FF'.",
+                                 archive_path, corrupt_path)
+                # Exclusive creation, so an existing archive can never be truncated
+                stream = open(archive_path, 'xb', buffering=ARCHIVE_BUFFER_SIZE)
+                archive = zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED,
+                                          compresslevel=self.compresslevel)
+            self.archives[(year, month)] = archive
+        return archive
+
+    @staticmethod
+    def _move_aside(archive_path):
+        """
+        Renames a damaged archive out of the way without replacing any earlier one.
+
+        Args:
+            archive_path (str): The path of the damaged archive.
+
+        Returns:
+            str: The path the archive was moved to.
+        """
+        corrupt_path = f"{archive_path}.corrupt"
+        suffix = 1
+        while os.path.exists(corrupt_path):
+            suffix += 1
+            corrupt_path = f"{archive_path}.corrupt{suffix}"
+        os.rename(archive_path, corrupt_path)
+        return corrupt_path
+
+    def _add_attachment(self, archive, name, attachment):
+        """
+        Adds one attachment to an archive.
+
+        Attachments whose extension is in STORED_ATTACHMENT_EXTENSIONS are already compressed,
+        so they are stored with ZIP_STORED instead of being deflated again.
+
+        Args:
+            archive (zipfile.ZipFile): The month archive to write into.
+            name (str): The entry name of the attachment inside the archive.
+            attachment (dict): The attachment's decoded 'data'.
+
+        Returns:
+            None
+        """
+        if os.path.splitext(name)[1].lower() in STORED_ATTACHMENT_EXTENSIONS:
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = archive.compression
+        archive.writestr(name, attachment['data'], compress_type=compress_type)
+
+    def write_buffer(self, email_buffer):
+        """
+        Writes buffered emails into their year/month archives.
+
+        Args:
+            email_buffer (list): A list of email data dictionaries.
+
+        Returns:
+            list: The message IDs of the emails that are now archived in full, or that were
+            written successfully by a run that only archives part of each email.
+        """
+        written_ids = []
+        emails_written = 0
+        attachments_saved = 0
+        for email_data in email_buffer:
+            try:
+                archive = self._get_archive(*get_archive_month(email_data))
+                # Entry names are plain zip keys, so the email's folder prefix is built once
+                entry_prefix = f"{email_data['folder_name']}/"
+                headers_info = archive.NameToInfo.get(entry_prefix + 'headers.txt')
+                if headers_info is not None and (
+                        headers_info.comment == COMPLETE_EMAIL_COMMENT or not email_data['complete']):
+                    # Already archived by an earlier run, at least as fully as this run would.
+                    # A complete email is written again over one archived only in part.
+                    if headers_info.comment == COMPLETE_EMAIL_COMMENT:
+                        written_ids.append(email_data['msg_id'])
+                    continue
+
+                # Save email content
+                for content_type, content in email_data['content_parts']:
+                    if content_type == 'text/plain':
+                        filename = 'email.txt'
+                    elif content_type == 'text/html':
+                        filename = 'email.html'
+                    else:
+                        continue
+                    archive.writestr(entry_prefix + filename, content)
+
+                # Save attachments
+                for attachment in email_data['attachments']:
+                    self._add_attachment(archive, entry_prefix + attachment['filename'], attachment)
+                    attachments_saved += 1
+
+                # Save headers last: headers.txt marks the email as archived, so it is only written
+                # once everything else made it into the archive. Its comment records whether the
+                # email was archived in full.
+                headers_text = (
+                    f"From: {email_data['sender']}\n"
+                    f"Date: {email_data['date_str']}\n"
+                    f"Subject: {email_data['subject']}\n"
+                    + ''.join(f"{header}: {value}\n" for header, value in email_data['headers'])
+                )
+                headers_info = zipfile.ZipInfo(entry_prefix + 'headers.txt', date_time=time.localtime()[:6])
+                headers_info.external_attr = 0o600 << 16
+                if email_data['complete']:
+                    headers_info.comment = COMPLETE_EMAIL_COMMENT
+                archive.writestr(headers_info, headers_text.encode('utf-8', errors='replace'),
+                                 compress_type=archive.compression, compresslevel=archive.compresslevel)
+
+                written_ids.append(email_data['msg_id'])
+                emails_written += 1
+            except Exception as e:
+                logger.error("Error writing email data to archive for %s: %s", email_data['folder_name'], e)
+
+        # Tallied per buffer so writer threads only contend for the lock once per buffer
+        with self.counter_lock:
+            self.emails_written += emails_written
+            self.attachments_saved += attachments_saved
+        return written_ids
+
+    def close(self):
+        """
+        Finalizes and closes every month archive.
+
+        Returns:
+            tuple: The space saved in bytes, the number of zip files created, and the original
+            (uncompressed) size of the data archived in this run in bytes.
+        """
+        original_size = 0
+        compressed_size = 0
+        for key, archive in self.archives.items():
+            original_size += sum(info.file_size for info in archive.infolist())
+            stream = archive.fp
+            archive.close()
+            # An append that added nothing leaves the position at the old central directory
+            stream.flush()
+            compressed_size += os.fstat(stream.fileno()).st_size
+            stream.close()
+            if key in self.existing_sizes:
+                existing_original_size, existing_compressed_size = self.existing_sizes[key]
+                original_size -= existing_original_size
+                compressed_size -= existing_compressed_size
+        zip_files_created = len(self.archives) - len(self.existing_sizes)
+        return original_size - compressed_size, zip_files_created, original_size
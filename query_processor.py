@@ -1,9 +1,41 @@
 import datetime
-import time
+import logging
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from constants import MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+def parse_date(date_str):
+    """
+    Parses a date given on the command line.
+
+    Args:
+        date_str (str): The date in mm-dd-yyyy or ISO 8601 (yyyy-mm-dd) format.
+
+    Returns:
+        datetime.date: The parsed date.
+    """
+    try:
+        return datetime.date.fromisoformat(date_str)
+    except ValueError:
+        return datetime.datetime.strptime(date_str, "%m-%d-%Y").date()
+
+
+def format_query_date(date):
+    """
+    Formats a date the way Gmail search expects it.
+
+    Args:
+        date (datetime.date): The date to format.
+
+    Returns:
+        str: The date in yyyy/mm/dd format.
+    """
+    return f"{date.year:04d}/{date.month:02d}/{date.day:02d}"
+
 
 def build_query(args):
     """
@@ -17,52 +49,47 @@ def build_query(args):
     """
     query = args.query
     if args.start_date:
-        start_date = datetime.datetime.strptime(args.start_date, "%m-%d-%Y").strftime('%Y/%m/%d')
-        query += f" after:{start_date}"
+        query += f" after:{format_query_date(parse_date(args.start_date))}"
     if args.end_date:
-        end_date = datetime.datetime.strptime(args.end_date, "%m-%d-%Y").strftime('%Y/%m/%d')
-        query += f" before:{end_date}"
+        query += f" before:{format_query_date(parse_date(args.end_date))}"
     if args.label:
         query += f" label:{args.label}"
-    query += " -in:spam -in:trash"
     return query.strip()
 
 
-def get_message_ids(creds, query):
+def iter_message_ids(service, query):
     """
-    Fetches email message IDs based on the provided query.
+    Streams email message IDs based on the provided query.
+
+    IDs are yielded page by page as the listing progresses, so callers can start working on the
+    first page before the last one has been fetched. Spam and trash are excluded by the listing
+    itself (includeSpamTrash=False) rather than by terms in the search query.
 
     Args:
-        creds (google.oauth2.credentials.Credentials): The credentials for accessing the Gmail API.
+        service (googleapiclient.discovery.Resource): The Gmail API service.
         query (str): The Gmail search query.
 
-    Returns:
-        list: A list of email message IDs that match the query.
+    Yields:
+        str: The ID of each email message that matches the query.
     """
-    global total_emails
-    service = build("gmail", "v1", credentials=creds)
-    message_ids = []
     page_token = None
 
     while True:
         try:
-            results = service.users().messages().list(userId="me", q=query, pageToken=page_token, maxResults=500).execute()
-            messages = results.get("messages", [])
-            if not messages:
-                break
-            message_ids.extend([msg["id"] for msg in messages])
-            page_token = results.get("nextPageToken")
-            if not page_token:
-                break
+            results = service.users().messages().list(
+                userId="me", q=query, pageToken=page_token, maxResults=500, includeSpamTrash=False,
+                fields="messages/id,nextPageToken"
+            ).execute(num_retries=MAX_RETRIES)
         except HttpError as error:
-            if error.resp.status == 429:
-                time.sleep(10)
-                continue
-            else:
-                print(f"HttpError while listing messages: {error}")
-                break
+            logger.error("HttpError while listing messages: %s", error)
+            break
         except Exception as e:
-            print(f"Unexpected error while listing messages: {e}")
+            logger.error("Unexpected error while listing messages: %s", e)
+            break
+        messages = results.get("messages", [])
+        if not messages:
+            break
+        yield from (msg["id"] for msg in messages)
+        page_token = results.get("nextPageToken")
+        if not page_token:
             break
-    total_emails = len(message_ids)
-    return message_ids
@@ -1,3 +1,62 @@
+import sys
+
+# The summary banner is laid out once, at import time, and only filled in per run
+SUMMARY_TEMPLATE = (
+    "\n✨ **Gmail Archiving Summary** ✨\n\n"
+    "🔍 **Filters Applied**: {filter_summary}\n"
+    "📧 **Emails Processed**: **{total_emails}**\n"
+    "{action_type}\n"
+    "📂 **Data Stored At**: {base_path}\n"
+    "{compression_summary}\n\n"
+    "🔒 Your emails are now securely archived, beautifully organized, and ready for future use! 🚀\n"
+)
+
+# The lines that vary per run are filled in with %-formatting
+DELETED_ACTION_TEMPLATE = "📤 **Archived and deleted** **%s** emails, saving 💾 **%s** of disk space."
+ARCHIVED_ACTION_TEMPLATE = (
+    "📤 **Archived** **%s** emails with 📎 **%s attachments**. "
+    "⚠️ While emails were not deleted, this could have saved 💾 **%s**."
+)
+COMPRESSION_SUMMARY_TEMPLATE = (
+    "📦 **Compression Complete**: Created **%s** zip files, shrinking emails from **%s**."
+)
+
+# ASCII art representing a secure archive
+ASCII_ART = """
+          ________________________
+         |########################|
+         |#  ________________   #|
+         |# |                |  #|
+         |# | Archiving Safe |  #|
+         |# |________________|  #|
+         |########################|
+         |########################|
+         |########################|
+         |########################|
+         |########################|
+         \\########################/
+          \\______________________/
+    📨 Mission accomplished! Your data is securely saved and organized! 📂
+    """
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+
+def format_size(size_in_bytes):
+    """
+    Converts bytes to a human-readable format.
+
+    Args:
+        size_in_bytes (float): The size in bytes.
+
+    Returns:
+        str: The size in the largest unit it reaches, with two decimals.
+    """
+    # Each unit is 2**10 times the last, so the bit length picks the unit without a loop
+    unit_index = 0 if size_in_bytes < 1024 else min((int(size_in_bytes).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{size_in_bytes / (1 << (10 * unit_index)):.2f} {SIZE_UNITS[unit_index]}"
+
+
 def summarize_statistics(start_date, end_date, base_path, query, label, delete, total_emails, emails_downloaded, emails_deleted, attachments_saved, original_size,
                          space_saved, zip_files_created):
     """
@@ -18,75 +77,41 @@ def summarize_statistics(start_date, end_date, base_path, query, label, delete,
         space_saved (float): Total disk space saved in bytes due to compression.
         zip_files_created (int): Number of zip files created during compression.
     """
-    def format_size(size_in_bytes):
-        """Converts bytes to a human-readable format."""
-        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-            if size_in_bytes < 1024:
-                return f"{size_in_bytes:.2f} {unit}"
-            size_in_bytes /= 1024
-        return f"{size_in_bytes:.2f} PB"
-
     # Prepare formatted sizes
     original_size_formatted = format_size(original_size)
     space_saved_formatted = format_size(space_saved)
 
     # Build the filter description
-    filters = []
+    filter_summary = ""
     if start_date and end_date:
-        filters.append(f"from **{start_date}** to **{end_date}**")
+        filter_summary = f"from **{start_date}** to **{end_date}**"
     elif start_date:
-        filters.append(f"starting from **{start_date}**")
+        filter_summary = f"starting from **{start_date}**"
     elif end_date:
-        filters.append(f"up to **{end_date}**")
+        filter_summary = f"up to **{end_date}**"
     if label:
-        filters.append(f"label: **'{label}'**")
+        filter_summary += f"{', ' if filter_summary else ''}label: **'{label}'**"
     if query:
-        filters.append(f"query: **'{query}'**")
-    filter_summary = ", ".join(filters) if filters else "**all emails**"
+        filter_summary += f"{', ' if filter_summary else ''}query: **'{query}'**"
+    filter_summary = filter_summary or "**all emails**"
 
     # Determine the action type
     if delete:
-        action_type = (
-            f"📤 **Archived and deleted** **{emails_deleted}** emails, saving 💾 **{space_saved_formatted}** of disk space."
-        )
+        action_type = DELETED_ACTION_TEMPLATE % (emails_deleted, space_saved_formatted)
     else:
-        action_type = (
-            f"📤 **Archived** **{emails_downloaded}** emails with 📎 **{attachments_saved} attachments**. "
-            f"⚠️ While emails were not deleted, this could have saved 💾 **{space_saved_formatted}**."
-        )
+        action_type = ARCHIVED_ACTION_TEMPLATE % (emails_downloaded, attachments_saved, space_saved_formatted)
 
     # Build the compression summary
-    compression_summary = f"📦 **Compression Complete**: Created **{zip_files_created}** zip files, shrinking emails from **{original_size_formatted}**."
-
-    # Construct the final message
-    final_message = (
-        f"\n✨ **Gmail Archiving Summary** ✨\n\n"
-        f"🔍 **Filters Applied**: {filter_summary}\n"
-        f"📧 **Emails Processed**: **{total_emails}**\n"
-        f"{action_type}\n"
-        f"📂 **Data Stored At**: {base_path}\n"
-        f"{compression_summary}\n\n"
-        f"🔒 Your emails are now securely archived, beautifully organized, and ready for future use! 🚀\n"
-    )
-
-    # Add ASCII art representing a secure archive
-    ascii_art = """
-          ________________________
-         |########################|
-         |#  ________________   #|
-         |# |                |  #|
-         |# | Archiving Safe |  #|
-         |# |________________|  #|
-         |########################|
-         |########################|
-         |########################|
-         |########################|
-         |########################|
-         \\########################/
-          \\______________________/
-    📨 Mission accomplished! Your data is securely saved and organized! 📂
-    """
+    compression_summary = COMPRESSION_SUMMARY_TEMPLATE % (zip_files_created, original_size_formatted)
+
+    # Fill in the final message
+    final_message = SUMMARY_TEMPLATE.format_map({
+        'filter_summary': filter_summary,
+        'total_emails': total_emails,
+        'action_type': action_type,
+        'base_path': base_path,
+        'compression_summary': compression_summary,
+    })
 
-    # Combine message and ASCII art
-    print(final_message)
-    print(ascii_art)
+    # Combine message and ASCII art into a single write
+    sys.stdout.write(f"{final_message}\n{ASCII_ART}\n")